@@ -14,29 +14,100 @@
         daemon      - continuously update targets by subscribing to the Docker event stream
 
 """
+from gevent import monkey
+monkey.patch_all(thread=False, select=False)
+
 import os
+import re
 import socket
+import time
 import json
 import logging
+from collections import defaultdict
+from contextlib import contextmanager
 import click
 import docker
+import gevent
+from gevent.lock import BoundedSemaphore, RLock, Semaphore
+from gevent.pool import Pool
+from gevent.queue import Queue, Full
 import requests
-from jsondiff import diff
-from jsondiff.symbols import Symbol
+import grequests
 import urllib3
+from urllib3.util.retry import Retry
+import ujson
 
-logging.basicConfig(level=os.getenv('LOG_LEVEL',logging.INFO))
 log = logging.getLogger('KongServiceRegistrator')
 
+_ENV_RE = re.compile(r'^(SERVICE|KONG)(?:_(\d+))?_(NAME|API)$')
+
 #
 # disable warnings on ssl usage (really irritating if you explicitly specify verify_ssl = False)
 #
 urllib3.disable_warnings()
 
 
+def response_json(r):
+    """
+    returns the decoded json body of the response `r`.
+    """
+    return ujson.loads(r.content)
+
+
+def has_update(current, definition):
+    """
+    returns True if any field of the API `definition` is missing or has a different value in the `current`
+    API definition.
+    """
+    return any(current.get(k) != v for k, v in definition.items())
+
+
+def publishes_tcp_port(summary):
+    """
+    returns True if the container `summary` from the container list publishes a tcp port on the host.
+    """
+    return any(p.get('PublicPort') and p.get('Type') == 'tcp' for p in summary.get('Ports') or [])
+
+
+@contextmanager
+def holding(locks):
+    """
+    acquires all `locks` in order, and releases them when the block is done.
+    """
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+
+def request_failed(request, exception):
+    """
+    logs the failure of a concurrent request to the Kong Admin API.
+    """
+    log.error('request %s %s failed, %s', request.method, request.url, exception)
+
+
+class BoundedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    an HTTP adapter which sends at most `max_concurrency` requests at the same time, no matter how
+    many greenlets share it.
+    """
+
+    def __init__(self, max_concurrency, **kwargs):
+        self.slots = BoundedSemaphore(max_concurrency)
+        super(BoundedHTTPAdapter, self).__init__(pool_maxsize=max_concurrency, **kwargs)
+
+    def send(self, request, **kwargs):
+        with self.slots:
+            return super(BoundedHTTPAdapter, self).send(request, **kwargs)
+
+
 class KongServiceRegistrator(object):
 
-    def __init__(self, admin_url, dns_name, hostname, verify_ssl):
+    def __init__(self, admin_url, dns_name, hostname, verify_ssl, concurrency=32):
         """
         constructor.
         """
@@ -49,59 +120,129 @@ class KongServiceRegistrator(object):
         self.dns_name = dns_name
         self.admin_url = admin_url
         self.verify_ssl = verify_ssl
+        self.concurrency = concurrency
+        self.session = requests.Session()
+        self.session.verify = verify_ssl
+        retries = Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = BoundedHTTPAdapter(concurrency, pool_connections=4, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.upstreams = {}
+        self.upstream_locks = defaultdict(Semaphore)
         self.targets = {}
+        self.container_targets = {}
+        self.container_locks = [Semaphore() for _ in range(64)]
+        self.pending_starts = set()
+        self.pending_starts_timer = None
+        self.pending_sync_timer = None
+        self.sync_lock = RLock()
+        self.start_delay = 0.2
+        self.sync_delay = 0.2
+        self.events = Queue(maxsize=256)
+        self.queued_events = set()
+        self.workers = Pool(16)
         self.apis = {}
+        self.apis_loaded_at = 0
+        self.apis_ttl = 30
 
         self.load()
 
-        assert self.hostname == hostname
-        assert self.dns_name == dns_name
-
-    def sync_upstream(self, upstream, targets):
+    def sync_upstreams(self, targets):
         """
-        synchronize all upstream targets on this machine with the targets registerted in Kong
+        synchronize the targets on this machine of all upstreams in `targets` with the targets
+        registered in Kong. The targets of all upstreams are added and removed concurrently.
         """
-        live = set(targets)
-        in_kong = set(map(lambda t: t['target'], self.targets[
-                      upstream])) if upstream in self.targets else set()
-        to_delete = in_kong - live
-        to_add = live - in_kong
-        for target in to_delete:
-            self.remove_target(upstream, target)
-        for target in to_add:
-            self.add_target(upstream, target)
+        to_add = []
+        to_delete = []
+        for upstream in targets:
+            live = set(targets[upstream])
+            in_kong = self.targets.get(upstream, {})
+            to_delete.extend((upstream, t) for t in in_kong if t not in live)
+            to_add.extend((upstream, t) for t in live if t not in in_kong)
+        self.update_targets(to_add, to_delete)
+
+    def update_targets(self, to_add, to_delete):
+        """
+        add and remove the (upstream, target) pairs in `to_add` and `to_delete` in Kong. All
+        requests are sent concurrently over the shared session. removed targets are dropped from
+        the cache before the requests are sent.
+        """
+        operations = []
+        reqs = []
+        for upstream in set(u for u, _ in to_add):
+            self.add_upstream(upstream)
+
+        for upstream, target in to_delete:
+            log.debug('removing target %s from upstream %s', target, upstream)
+            operations.append(('delete', upstream, target))
+            record = self.targets.get(upstream, {}).pop(target, None)
+            target_id = record['id'] if record is not None else target
+            reqs.append(grequests.delete('%s/upstreams/%s/targets/%s' % (self.admin_url, upstream, target_id),
+                                         session=self.session))
+        for upstream, target in to_add:
+            if upstream not in self.upstreams:
+                continue  # failed to add upstream, already logged
+            log.debug('adding target %s to upstream %s', target, upstream)
+            operations.append(('add', upstream, target))
+            reqs.append(grequests.post('%s/upstreams/%s/targets' % (self.admin_url, upstream),
+                                       json={'target': target}, session=self.session))
+
+        responses = grequests.map(reqs, size=self.concurrency, exception_handler=request_failed)
+        for (operation, upstream, target), r in zip(operations, responses):
+            if operation == 'delete':
+                if r is not None and r.status_code != 204:
+                    log.error(
+                        'failed to remove target %s from upstream %s at %s: %d, %s',
+                        target, upstream, r.url, r.status_code, r.text)
+            elif r is not None:
+                if r.status_code == 200 or r.status_code == 201:
+                    self.targets[upstream][target] = response_json(r)
+                else:
+                    log.error(
+                        'failed to add target %s to upstream %s at %s: %d, %s',
+                        target, upstream, self.admin_url, r.status_code, r.text)
 
     def load_apis(self):
         """
-        load all current API definition from Kong into self.apis
+        load all current API definition from Kong into self.apis. self.apis is only replaced
+        when all API definitions are loaded.
         """
-        self.apis = {}
-        next_page = '%s/apis?size=100' % self.admin_url
+        apis = {}
+        next_page = '%s/apis?size=1000' % self.admin_url
         while next_page:
-            r = requests.get(next_page, verify=self.verify_ssl)
+            r = self.session.get(next_page)
             if r.status_code == 200:
-                response = r.json()
-                next_page = response['next'] if 'next' in response else None
+                response = response_json(r)
+                next_page = response.get('next')
                 for api in response['data']:
-                    self.apis[api['name']] = api
+                    apis[api['name']] = api
             elif r.status_code == 404:
                 next_page = None
             else:
                 log.error('failed to get apis at %s, %s',
                           self.admin_url, r.text)
+                self.apis_loaded_at = 0
+                return
+        self.apis = apis
+        self.apis_loaded_at = time.time()
+
+    def apis_outdated(self):
+        """
+        returns True if the API definitions in self.apis were loaded more than `self.apis_ttl` seconds ago.
+        """
+        return time.time() - self.apis_loaded_at > self.apis_ttl
 
     def load_upstreams(self):
         """
         load all upstreams from Kong into self.upstreams
         """
         self.upstreams = {}
-        next_page = '%s/upstreams?size=100' % self.admin_url
+        next_page = '%s/upstreams?size=1000' % self.admin_url
         while next_page:
-            r = requests.get(next_page, verify=self.verify_ssl)
+            r = self.session.get(next_page)
             if r.status_code == 200:
-                response = r.json()
-                next_page = response['next'] if 'next' in response else None
+                response = response_json(r)
+                next_page = response.get('next')
                 for upstream in response['data']:
                     if upstream['name'].endswith(self.dns_name):
                         self.upstreams[upstream['name']] = upstream
@@ -110,208 +251,167 @@ class KongServiceRegistrator(object):
             else:
                 log.error('failed to get upstreams at %s, %s',
                           self.admin_url, r.text)
+                next_page = None
 
-    def load_targets(self, upstream):
+    def load_targets(self, upstream, r):
         """
-        load all targets pointing to `self.hostname` for the upstream 'upstream'.
+        store all targets pointing to `self.hostname` on the targets of upstream `upstream`, starting
+        from the first page `r` of its target records. Only the latest record of each target is kept, and
+        targets with weight 0 are removed.
         """
-        self.targets[upstream] = []
-        url = '%s/upstreams/%s/targets/active/' % (self.admin_url, upstream)
-        r = requests.get(url, verify=self.verify_ssl)
-        if r.status_code == 200:
-            response = r.json()
-	    own_targets = filter(lambda t: t['target'].startswith('%s:' % self.hostname), response['data'])
-	    self.targets[upstream].extend(own_targets)
+        self.targets[upstream] = {}
+        records = []
+        while r is not None:
+            if r.status_code == 200:
+                response = response_json(r)
+                records.extend(t for t in response['data'] if t['target'].startswith('%s:' % self.hostname))
+                next_page = response.get('next')
+                r = self.session.get(next_page) if next_page else None
+            elif r.status_code == 404:
+                return  # no targets yet..
+            else:
+                log.error('failed to get targets of %s at %s, %d, %s',
+                          upstream, r.url, r.status_code, r.text)
+                return
 
-        elif r.status_code == 404:
-            pass  # no targets yet..
-        else:
-            log.error('failed to get targets of %s at %s, %d, %s',
-                      upstream, r.url, r.status_code, r.text)
+        latest = {}
+        for t in sorted(records, key=lambda t: t['created_at']):
+            latest[t['target']] = t
+        self.targets[upstream] = {k: t for k, t in latest.items() if t.get('weight') != 0}
 
     def load(self):
         """
-        load all upstream targets from Kong.
+        load all upstream targets from Kong. The first pages of the targets of the upstreams are
+        requested concurrently.
         """
         self.load_upstreams()
-        for upstream in self.upstreams:
-            self.load_targets(upstream)
+        upstreams = list(self.upstreams)
+        reqs = [grequests.get('%s/upstreams/%s/targets?size=1000' % (self.admin_url, upstream),
+                              session=self.session) for upstream in upstreams]
+        responses = grequests.map(reqs, size=self.concurrency, exception_handler=request_failed)
+        for upstream, r in zip(upstreams, responses):
+            self.load_targets(upstream, r)
 
     def add_upstream(self, name):
         """
-        add the upstream `name' to Kong.
-        """
-        if name not in self.upstreams:
-            r = requests.post(
-                '%s/upstreams/' % self.admin_url, json={'name': name},
-                verify=self.verify_ssl)
-            if r.status_code == 409:
-                r = requests.get(
-                    '%s/upstreams/%s' % (self.admin_url, name),
-                    verify=self.verify_ssl)
-            if r.status_code == 200 or r.status_code == 201:
-                self.upstreams[name] = r.json()
-                self.targets[name] = []
-            else:
-                log.error(
-                    'failed to add upstream %s at %s, status code %d, %s',
-                    name, r.url, r.status_code, r.text)
-        else:
-            # upstream already exists
-            pass
-
-    def add_target(self, name, target):
-        """
-        add the target `target` to the upstream `name` in Kong.
-        """
-        log.info('adding target %s to upstream %s', target, name)
-        self.add_upstream(name)
-        targets = self.targets[name]
-        targets = filter(lambda t: t['target'] ==
-                         target and t['weight'] != 0, targets)
-        if len(targets) == 0:
-            r = requests.post('%s/upstreams/%s/targets' %
-                              (self.admin_url, name),
-                              json={'target': target},
-                              verify=self.verify_ssl)
-            if r.status_code == 200 or r.status_code == 201:
-                self.targets[name].append(r.json())
-            else:
-                log.error(
-                    'failed to add target %s to upstream %s at %s: %d, %s',
-                    target, name, self.admin_url, r.status_code, r.text)
-        else:
-            # target already exists
-            log.debug(
-                'target "%s" for upstream "%s" is already registered', target,
-                name)
-            pass
-
-    def remove_target(self, name, target):
-        """
-        remove the target `target` from the upstream `name` in Kong.
+        add the upstream `name' to Kong. concurrent calls for the same upstream result in a single
+        request to Kong.
         """
-        log.info('removing target %s from upstream %s',
-                 target, name)
-        url = '%s/upstreams/%s/targets/%s' % (self.admin_url, name, target)
-        r = requests.delete(url, verify=self.verify_ssl)
-        if r.status_code != 204:
-            log.error(
-                'failed to remove target %s from upstream %s at %s: %d, %s',
-                target, name, r.url, r.status_code, r.text)
-
-        self.targets[name] = filter(
-            lambda t: t['target'] != target, self.targets[name])
+        with self.upstream_locks[name]:
+            if name not in self.upstreams:
+                r = self.session.post(
+                    '%s/upstreams/' % self.admin_url, json={'name': name})
+                if r.status_code == 409:
+                    r = self.session.get(
+                        '%s/upstreams/%s' % (self.admin_url, name))
+                if r.status_code == 200 or r.status_code == 201:
+                    self.upstreams[name] = response_json(r)
+                    self.targets[name] = {}
+                else:
+                    log.error(
+                        'failed to add upstream %s at %s, status code %d, %s',
+                        name, r.url, r.status_code, r.text)
+            else:
+                # upstream already exists
+                pass
 
     def get_environment_of_container(self, container):
         """
         returns the environment variables of the container as a dictionary.
         """
-        assert container is not None
-
-        result = {}
-        env = container.attrs['Config']['Env']
-        for e in env:
-            parameter = e.split('=', 1)
-            result[parameter[0]] = parameter[1]
-
-        assert len(env) == len(container.attrs['Config']['Env'])
+        return dict(e.split('=', 1) for e in container.attrs['Config']['Env'])
 
-        return result
-
-    def sync_apis(self, apis):
+    def sync_apis(self, apis, force_reload=False):
         """
-        synchronizes the API definition defined on this machine with Kong.
+        synchronizes the API definition defined on this machine with the API definitions
+        in self.apis. reloads the API definitions from Kong first, if they are outdated or
+        `force_reload` is set.
         """
-        self.load_apis()
+        if len(apis) == 0:
+            return
+
+        if force_reload or self.apis_outdated():
+            self.load_apis()
         for name in apis:
             definition = apis[name]
             if name in self.apis:
-                                # api with the same name already exists, check
-                                # for update
-                current = self.apis[name]
-                differences = diff(current, definition, syntax='explicit')
-                has_update = filter(lambda k: k.label == 'update', differences.keys())
-                if len(has_update) > 0:
+                # api with the same name already exists, check for update
+                if has_update(self.apis[name], definition):
                     log.info('updating API definition %s.', name)
-                    r = requests.patch(
+                    r = self.session.patch(
                         '%s/apis/%s' % (self.admin_url, name),
-                        json=definition, verify=self.verify_ssl)
+                        json=definition)
                     if r.status_code == 200 or r.status_code == 201:
-                        self.apis[name] = r.json()
+                        self.apis[name] = response_json(r)
                     else:
+                        self.apis_loaded_at = 0
                         log.error('failed to update %s at %s, %s',
                                   name, self.admin_url, r.text)
                 else:
-                    log.info('API definition %s is up-to-date.', name)
+                    log.debug('API definition %s is up-to-date.', name)
             else:
                 log.info('creating API definition %s.', name)
-                r = requests.put('%s/apis/' % self.admin_url,
-                                 json=definition, verify=self.verify_ssl)
+                r = self.session.put('%s/apis/' % self.admin_url,
+                                     json=definition)
                 if r.status_code == 200 or r.status_code == 201:
-                    self.apis[name] = r.json()
+                    self.apis[name] = response_json(r)
                 else:
+                    self.apis_loaded_at = 0
                     log.error('failed to create %s at %s, %s',
                               name, self.admin_url, r.text)
 
-    def get_all_exposed_tcp_ports(self, container):
+    def get_all_exposed_tcp_ports(self, tcp_ports):
         """
-        returns all TCP ports exposed by `container`.
+        returns all exposed ports of the TCP ports `tcp_ports` of a container.
         """
-        ports = container.attrs['NetworkSettings']['Ports']
-        return dict((k, v) for k, v in ports.items()
-                    if k.endswith('/tcp') and v is not None)
+        return {k: v for k, v in tcp_ports.items() if v is not None}
 
     def get_all_tcp_ports(self, container):
         """
         returns all publishable TCP ports by `container`.
         """
-        ports = container.attrs['NetworkSettings']['Ports']
-        return dict((k, v) for k, v in ports.items() if k.endswith('/tcp'))
+        ports = container.attrs['NetworkSettings']['Ports'] or {}
+        return {k: v for k, v in ports.items() if k[-4:] == '/tcp'}
 
-    def get_environment_value_for_port(self, container, prefix, postfix, port):
+    def get_port_settings(self, env, tcp_ports):
         """
-        gets the environment variable for `prefix`_`port.split('/')[0]`_`postfix` or
-        for `prefix`_`postfix if the number of exposed ports == 1.
+        classifies the `prefix`_`port_number`_`postfix` and `prefix`_`postfix` variables of the
+        container environment `env` in a single pass, and returns a dictionary of the values per
+        port number and (`prefix`, `postfix`). `tcp_ports` are all the tcp ports of the container.
 
-        if no such environment variable exists or `prefix`_IGNORE is set, None is returned.
+        `prefix`_`postfix` applies to the port only if the container has a single tcp port.
+        if `prefix`_IGNORE is set, the variables with that prefix are ignored.
         """
-        env = self.get_environment_of_container(container)
-        tcp_ports = self.get_all_tcp_ports(container)
+        settings = defaultdict(dict)
+        for key, value in env.items():
+            match = _ENV_RE.match(key)
+            if match is not None and '%s_IGNORE' % match.group(1) not in env:
+                settings[match.group(2) or '_default'][(match.group(1), match.group(3))] = value
 
-        ignore_name = '%s_IGNORE' % prefix
-        if ignore_name in env:
-            return None
+        defaults = settings.pop('_default', {})
+        if len(tcp_ports) == 1:
+            port_settings = settings[next(iter(tcp_ports)).partition('/')[0]]
+            for key, value in defaults.items():
+                port_settings.setdefault(key, value)
 
-        full_name = '%s_%s' % (prefix, postfix)
-        port_name = '%s_%s_%s' % (prefix, port.split('/')[0], postfix)
-        env = self.get_environment_of_container(container)
+        return settings
 
-        if port_name in env:
-            return env[port_name]
-
-        if full_name in env and len(tcp_ports) == 1:
-            return env[full_name]
-
-        return None
-
-    def get_service_name_for_port(self, container, port):
+    def get_service_name_for_port(self, settings, port_number):
         """
-        get the value of the SERVICE_NAME environment variable for the specified `port`.
+        get the value of the SERVICE_NAME environment variable for the specified `port_number`.
         """
-        return self.get_environment_value_for_port(
-            container, 'SERVICE', 'NAME', port)
+        return settings.get(port_number, {}).get(('SERVICE', 'NAME'))
 
-    def get_kong_api_for_port(self, container, port):
+    def get_kong_api_for_port(self, settings, port_number):
         """
-        get the value of the KONG_API environment variable for the specified `port`.
+        get the value of the KONG_API environment variable for the specified `port_number`.
         """
-        return self.get_environment_value_for_port(
-            container, 'KONG', 'API', port)
+        return settings.get(port_number, {}).get(('KONG', 'API'))
 
-    def get_api_definitions(self, container):
+    def get_api_definitions(self, container, settings, tcp_ports):
         """
-        gets the Kong API definitions for the container.
+        gets the Kong API definitions for the container, given its port `settings` and its
+        tcp ports `tcp_ports`.
 
         the API definition is specified through the Port environment variable
         KONG_API.
@@ -322,15 +422,16 @@ class KongServiceRegistrator(object):
         while the  upstream_url will be set to http://<service_name><self.dns_name>'.
         """
         result = {}
-        ports = self.get_all_exposed_tcp_ports(container)
+        ports = self.get_all_exposed_tcp_ports(tcp_ports)
 
         for port in ports:
-            api_definition = self.get_kong_api_for_port(container, port)
+            port_number = port.partition('/')[0]
+            api_definition = self.get_kong_api_for_port(settings, port_number)
 
             if api_definition is None:
                 continue
 
-            service_name = self.get_service_name_for_port(container, port)
+            service_name = self.get_service_name_for_port(settings, port_number)
             upstream = 'http://%s%s' % (service_name,
                                         self.dns_name) if service_name is not None else None
 
@@ -340,11 +441,10 @@ class KongServiceRegistrator(object):
                     api_definition['upstream_url'] = upstream
                 if 'name' not in api_definition and service_name is not None:
                     api_definition['name'] = service_name
-            except ValueError as e:
+            except (ValueError, TypeError) as e:
                 log.error(
                     'invalid KONG API definition for port %s of container %s, %s',
-                    port, container.name,
-                    e.message)
+                    port, container.name, e)
                 continue
 
             if 'name' not in api_definition:
@@ -363,9 +463,10 @@ class KongServiceRegistrator(object):
 
         return result
 
-    def get_upstream_targets(self, container):
+    def get_upstream_targets(self, container, settings, tcp_ports):
         """
-        get Kong upstream targets definition for the container.
+        get Kong upstream targets definition for the container, given its port `settings` and
+        its tcp ports `tcp_ports`.
 
         for each exposed port which has a SERVICE_NAME specified a
         entry will be added to the returned dictionary.
@@ -375,10 +476,10 @@ class KongServiceRegistrator(object):
         duplicate service names are not allowed.
         """
         result = {}
-        ports = self.get_all_exposed_tcp_ports(container)
+        ports = self.get_all_exposed_tcp_ports(tcp_ports)
 
         for port in ports:
-            service_name = self.get_service_name_for_port(container, port)
+            service_name = self.get_service_name_for_port(settings, port.partition('/')[0])
             if service_name is None:
                 continue
 
@@ -394,87 +495,235 @@ class KongServiceRegistrator(object):
 
         return result
 
-    def container_died(self):
+    def container_died(self, container_id):
         """
-        remove all invalid upstream targets. requires a full synchronization as we cannot link the
-        targets to the container id.
+        remove all upstream targets of the specified container. schedules a full synchronization
+        if the targets of the container are unknown.
         """
-        self.sync()
+        self.pending_starts.discard(container_id)
+        with self.container_lock(container_id):
+            if container_id not in self.container_targets:
+                self.schedule_sync()
+                return
+
+            self.update_targets([], self.container_targets.pop(container_id))
 
-    def container_started(self, container_id):
+    def container_lock(self, container_id):
         """
-        create upstream targets for all exposed services of the specified container.
+        returns the lock which serializes the handling of the events of the container `container_id`.
         """
-        try:
-            container = self.dockr.containers.get(container_id)
-            state = container.attrs['State']['Health']['Status'] if 'Health' in container.attrs['State'] else None
-	    if state is None or state == 'healthy':
-		targets = self.get_upstream_targets(container)
-		if len(targets) > 0:
-		    for upstream in targets:
-			self.add_target(upstream, targets[upstream])
-
-		apis = self.get_api_definitions(container)
-		self.sync_apis(apis)
-	    else:
-                log.info('container %s is not healthy.', container.name)
-		return
+        return self.container_locks[hash(container_id) % len(self.container_locks)]
 
-        except docker.errors.NotFound:
-            log.error('container %s does not exist.', container_id)
+    def locks_of_containers(self, container_ids):
+        """
+        returns the locks of the containers `container_ids`, in the order in which they must be acquired.
+        """
+        return sorted(set(self.container_lock(container_id) for container_id in container_ids), key=id)
 
-    def sync(self):
+    def containers_started(self, containers):
         """
-        ensure that the upstream targets are
-        actually reflecting docker instances running on this host.
+        create upstream targets and API definitions for all exposed services of the specified containers.
         """
-        targets = {upstream: [] for upstream in self.targets}
         apis = {}
-        containers = self.dockr.containers.list()
+        to_add = []
         for container in containers:
-            state = container.attrs['State']['Health']['Status'] if 'Health' in container.attrs['State'] else  None
+            if not container.attrs['State'].get('Running'):
+                log.info('container %s is no longer running.', container.name)
+                continue
 
+            state = container.attrs['State'].get('Health', {}).get('Status')
             if state is None or state == 'healthy':
-		container_targets = self.get_upstream_targets(container)
-		for upstream in container_targets:
-		  if upstream not in targets:
-		      targets[upstream] = []
-		  targets[upstream].append(container_targets[upstream])
-
-		container_apis = self.get_api_definitions(container)
-		apis.update(container_apis)
-	    else:
+                env = self.get_environment_of_container(container)
+                tcp_ports = self.get_all_tcp_ports(container)
+                settings = self.get_port_settings(env, tcp_ports)
+                targets = self.get_upstream_targets(container, settings, tcp_ports)
+                self.container_targets[container.id] = list(targets.items())
+                for upstream, target in targets.items():
+                    registered = self.targets.get(upstream, {}).get(target)
+                    if registered is None or registered.get('weight') == 0:
+                        to_add.append((upstream, target))
+                    else:
+                        log.debug('target "%s" for upstream "%s" is already registered', target, upstream)
+
+                apis.update(self.get_api_definitions(container, settings, tcp_ports))
+            else:
                 log.info('container %s is not healthy.', container.name)
 
-        for upstream in targets:
-            self.sync_upstream(upstream, targets[upstream])
+        self.update_targets(to_add, [])
         self.sync_apis(apis)
 
+    def schedule_container_started(self, container_id):
+        """
+        schedule the creation of the upstream targets for the specified container. containers
+        started within `self.start_delay` seconds of each other are processed as a single batch.
+        """
+        self.pending_starts.add(container_id)
+        if self.pending_starts_timer is None:
+            self.pending_starts_timer = gevent.spawn_later(self.start_delay, self._flush_starts)
+
+    def schedule_sync(self):
+        """
+        schedule a full synchronization. all requests for a synchronization within `self.sync_delay`
+        seconds of each other, or while a synchronization is running, result in a single synchronization.
+        """
+        if self.pending_sync_timer is None:
+            self.pending_sync_timer = gevent.spawn_later(self.sync_delay, self._scheduled_sync)
+
+    def _scheduled_sync(self):
+        """
+        perform a scheduled full synchronization, after the running synchronization has finished.
+        """
+        with self.sync_lock:
+            self.pending_sync_timer = None
+            self.sync()
+
+    def _flush_starts(self):
+        """
+        create upstream targets and API definitions for all pending started containers in a single
+        batch. every pending container is inspected once, as with individual start events; the batch
+        saves on Kong Admin API calls.
+        """
+        self.pending_starts_timer = None
+        pending, self.pending_starts = self.pending_starts, set()
+        with holding(self.locks_of_containers(pending)):
+            self.containers_started(self.inspect_containers(pending))
+
+    def list_running_containers(self):
+        """
+        returns the summaries of all running containers, without inspecting them.
+        """
+        return self.dockr.api.containers(filters={'status': 'running'})
+
+    def inspect_containers(self, container_ids):
+        """
+        returns the containers with the ids `container_ids`, skipping containers which no longer exist.
+        """
+        result = []
+        for container_id in container_ids:
+            try:
+                result.append(self.dockr.containers.get(container_id))
+            except docker.errors.NotFound:
+                log.debug('container %s no longer exists.', container_id)
+        return result
+
+    def sync(self):
+        """
+        ensure that the upstream targets are
+        actually reflecting docker instances running on this host. only one synchronization
+        runs at a time, and no container events are handled while it runs.
+        """
+        with self.sync_lock, holding(sorted(self.container_locks, key=id)):
+            targets = {upstream: [] for upstream in self.targets}
+            apis = {}
+            summaries = self.list_running_containers()
+            self.container_targets = {s['Id']: [] for s in summaries if not publishes_tcp_port(s)}
+            containers = self.inspect_containers(s['Id'] for s in summaries if publishes_tcp_port(s))
+            for container in containers:
+                if not container.attrs['State'].get('Running'):
+                    log.info('container %s is no longer running.', container.name)
+                    continue
+
+                self.container_targets[container.id] = []
+                state = container.attrs['State'].get('Health', {}).get('Status')
+                if state is None or state == 'healthy':
+                    env = self.get_environment_of_container(container)
+                    tcp_ports = self.get_all_tcp_ports(container)
+                    settings = self.get_port_settings(env, tcp_ports)
+                    container_targets = self.get_upstream_targets(container, settings, tcp_ports)
+                    self.container_targets[container.id] = list(container_targets.items())
+                    for upstream in container_targets:
+                        if upstream not in targets:
+                            targets[upstream] = []
+                        targets[upstream].append(container_targets[upstream])
+
+                    container_apis = self.get_api_definitions(container, settings, tcp_ports)
+                    apis.update(container_apis)
+                else:
+                    log.info('container %s is not healthy.', container.name)
+
+            apis_loader = gevent.spawn(self.load_apis) if len(apis) > 0 and self.apis_outdated() else None
+            self.sync_upstreams(targets)
+            if apis_loader is not None:
+                apis_loader.join()
+            self.sync_apis(apis)
+
     def remove_all(self):
         """
-        remove all targets pointing to this host.
+        remove all targets pointing to this host. The targets are removed concurrently.
         """
+        work = [(upstream, target, record['id'])
+                for upstream in self.targets for target, record in self.targets[upstream].items()]
+        reqs = []
+        for upstream, target, target_id in work:
+            log.debug('removing target %s from upstream %s', target, upstream)
+            reqs.append(grequests.delete('%s/upstreams/%s/targets/%s' % (self.admin_url, upstream, target_id),
+                                         session=self.session))
+
+        responses = grequests.map(reqs, size=self.concurrency, exception_handler=request_failed)
+        for (upstream, target, _), r in zip(work, responses):
+            if r is not None and r.status_code != 204:
+                log.error(
+                    'failed to remove target %s from upstream %s at %s: %d, %s',
+                    target, upstream, r.url, r.status_code, r.text)
+
         for upstream in self.targets:
-            for target in self.targets[upstream]:
-                self.remove_target(upstream, target['target'])
+            self.targets[upstream] = {}
 
     def process_events(self):
         """
-        Process docker container start and die events.
-        """
-        for e in self.dockr.events():
-            lines = filter(lambda l: len(l) > 0, e.split('\n'))
-            for line in lines:
-                event = json.loads(line)
-                if event['Type'] == 'container':
-                    if event['status'] == 'start' or event['status'] == 'health_status: healthy':
-                        self.container_started(event['id'])
-                    if event['status'] == 'die' or event['status'] == 'health_status: unhealthy':
-                        self.container_died()
-		    else:
-                        log.debug('skipping event "%s"', event['status'])
+        Process docker container start and die events. The events are queued and handled by a
+        bounded pool of workers, so that a burst of events does not overload the Kong Admin API.
+        """
+        dispatcher = gevent.spawn(self._dispatch_events)
+        try:
+            events = self.dockr.events(decode=True, filters={
+                'type': 'container', 'event': ['start', 'die', 'health_status']})
+            for event in events:
+                status = event['status']
+                if status == 'start' or status == 'health_status: healthy':
+                    self._enqueue_event('start', event['id'])
+                elif status == 'die' or status == 'health_status: unhealthy':
+                    self._enqueue_event('die', event['id'])
                 else:
-                    pass  # boring...
+                    log.debug('skipping event "%s"', status)
+        finally:
+            dispatcher.kill()
+
+    def _enqueue_event(self, action, container_id):
+        """
+        queue the `action` for the container, unless the same action is already queued.
+        when the queue is full, the event is dropped and a full synchronization is scheduled instead, so
+        that reading the Docker event stream never blocks.
+        """
+        event = (action, container_id)
+        if event in self.queued_events:
+            log.debug('skipping duplicate %s event for container %s', action, container_id)
+            return
+        try:
+            self.events.put_nowait(event)
+            self.queued_events.add(event)
+        except Full:
+            log.warn('event queue is full, dropping %s event for container %s and scheduling a full sync',
+                     action, container_id)
+            self.schedule_sync()
+
+    def _dispatch_events(self):
+        """
+        hands the queued events to the worker pool. blocks when all workers are busy.
+        """
+        while True:
+            action, container_id = self.events.get()
+            self.workers.spawn(self._handle_event, action, container_id)
+
+    def _handle_event(self, action, container_id):
+        """
+        processes a single queued container event.
+        """
+        self.queued_events.discard((action, container_id))
+        if action == 'start':
+            self.schedule_container_started(container_id)
+        else:
+            self.container_died(container_id)
 
 
 @click.group()
@@ -490,9 +739,12 @@ class KongServiceRegistrator(object):
 @click.option(
     '--verify-ssl/--no-verify-ssl', required=False, default=True,
     help='verify ssl connection to Kong Admin API')
+@click.option(
+    '--concurrency', required=False, default=32, type=int,
+    help='maximum number of concurrent requests to the Kong Admin API')
 @click.pass_context
-def cli(ctx, dns_name, hostname, admin_url, verify_ssl):
-    e = KongServiceRegistrator(admin_url, dns_name, hostname, verify_ssl)
+def cli(ctx, dns_name, hostname, admin_url, verify_ssl, concurrency):
+    e = KongServiceRegistrator(admin_url, dns_name, hostname, verify_ssl, concurrency)
     ctx.obj['registrator'] = e
 
 
@@ -526,5 +778,7 @@ def sync(ctx):
     e = ctx.obj['registrator']
     e.sync()
 
+
 if __name__ == '__main__':
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', logging.INFO))
     cli(obj={})